@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
     name='socklocks',
-    version='0.1.1',
+    version='0.2.0',
     description='Library of Python locks that use sockets to keep processes '
                 'synchronized.',
     long_description=open('README.md').read(),
@@ -1,10 +1,13 @@
-import array
+import base64
+import errno
+import functools
+import hashlib
 import logging
 import os.path
 import platform
 import random
+import select
 import socket
-import string
 import sys
 import tempfile
 import time
@@ -23,15 +26,83 @@ SUPPORTS_CMSG_SHARE = (
     and hasattr(socket, 'SCM_RIGHTS')
 )
 SUPPORTS_ANY_SHARE = hasattr(socket.socket, 'share')
+SUPPORTS_UNIX_SEQPACKET = (
+    SUPPORTS_UNIX_SOCKS
+    and hasattr(socket, 'SOCK_SEQPACKET')
+    and platform.system() == 'Linux'
+)
 DEFAULT_ALLOWED_PORTS = range(10000, 65536)
-SIMPLE_CHAR_BYTES = (string.ascii_lowercase + string.digits).encode('ascii')
+if SUPPORTS_UNIX_SEQPACKET:
+    # Keeps the handoff byte and its fd together in one message.
+    _UNIX_SOCK_TYPE = socket.SOCK_SEQPACKET
+else:
+    _UNIX_SOCK_TYPE = socket.SOCK_STREAM
 
 dword = Struct('L')
+_FD_STRUCT = Struct('i')
+_FD_PACK = _FD_STRUCT.pack
+if SUPPORTS_CMSG_SHARE:
+    _CMSG_LEN_1_FD = socket.CMSG_LEN(_FD_STRUCT.size)
+    # Has the kernel mark received fds close-on-exec, where supported.
+    _RECVMSG_FLAGS = getattr(socket, 'MSG_CMSG_CLOEXEC', 0)
 logger = logging.getLogger(__name__)
 
 
-def hashable_to_port_number(hashable):
-    hash(hashable)
+def name_to_port_number(
+    name: Union[bytes, bytearray, memoryview],
+    allowed_ports: Union[range, tuple, list] = DEFAULT_ALLOWED_PORTS
+) -> int:
+    # hash() is salted per process, so it can't be used to agree on a port
+    # across independently started processes. Four bytes is plenty to spread
+    # names over a 16-bit port range.
+    digest = hashlib.blake2s(name, digest_size=4).digest()
+    return allowed_ports[int.from_bytes(digest, 'little') % len(allowed_ports)]
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> Optional[bytearray]:
+    # Fills a preallocated buffer in place instead of growing one per recv.
+    # Returns None if the peer disconnects first.
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        recvd_size = sock.recv_into(view[received:])
+        if not recvd_size:
+            return None
+        received += recvd_size
+    return buffer
+
+
+if hasattr(select, 'kqueue'):
+    # Lets a waiter block until entries are added to or removed from a
+    # directory, e.g. a lock's socket file being unlinked.
+    class _DirectoryWatch:
+        def __init__(self, path):
+            self._dir_fd = os.open(path, getattr(os, 'O_EVTONLY', os.O_RDONLY))
+            self._kqueue = select.kqueue()
+            self._kqueue.control((select.kevent(
+                self._dir_fd,
+                filter=select.KQ_FILTER_VNODE,
+                flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                fflags=select.KQ_NOTE_WRITE
+            ),), 0)
+
+        def wait(self, timeout):
+            self._kqueue.control(None, 1, timeout)
+
+        def close(self):
+            self._kqueue.close()
+            os.close(self._dir_fd)
+else:
+    _DirectoryWatch = None
+
+# Upper bound on a directory wait, for when the retry was caused by something
+# other than the socket file changing, like a listener that hasn't called
+# listen() yet.
+_DIRECTORY_WAIT_TIMEOUT = 0.01
+# How long an address we can't bind can keep refusing connections before we
+# give up on it, rather than spin on bind and connect forever.
+_REFUSED_CONNECT_TIMEOUT = 0.1
 
 
 class SocketLock(AbstractContextManager):
@@ -48,155 +119,294 @@ class SocketLock(AbstractContextManager):
             name = name.encode('ascii')
 
         self._needs_unlink = False
-        if SUPPORTS_ABSTRACT_SOCKS and SUPPORTS_CMSG_SHARE:
-            self._addr_family = socket.AF_UNIX
+        self._name = self._init_addr(name, allowed_inet_ports)
+        # Family and type never change for an instance.
+        self._make_socket = functools.partial(
+            socket.socket,
+            self._addr_family,
+            self._sock_type
+        )
+        self._max_waiters = max_waiters
+        self._socket = None
+
+    # The platform can't change at runtime, so the address scheme is picked
+    # once here rather than on every construction.
+    if SUPPORTS_ABSTRACT_SOCKS and SUPPORTS_CMSG_SHARE:
+        def _init_addr(self, name, allowed_inet_ports):
             if not name:
-                namelen = 107 - len(self.PREFIX)
-                name = bytes([random.getrandbits(8) for _ in range(namelen)])
-            self._addr = b'\x00' + self.PREFIX + name
-        elif SUPPORTS_UNIX_SOCKS and SUPPORTS_CMSG_SHARE:
+                name = os.urandom(107 - len(self.PREFIX))
             self._addr_family = socket.AF_UNIX
+            self._sock_type = _UNIX_SOCK_TYPE
+            self._addr = b'\x00' + self.PREFIX + name
+            return name
+
+    elif SUPPORTS_UNIX_SOCKS and SUPPORTS_CMSG_SHARE:
+        # Temp dir lookup and path joining only need to happen once.
+        _TEMP_DIR_PREFIX = os.path.join(tempfile.gettempdirb(), b'')
+
+        def _init_addr(self, name, allowed_inet_ports):
             if not name:
                 name_len = random.randint(4, 22)
-                name = bytes(random.choices(SIMPLE_CHAR_BYTES, k=name_len))
-            self._addr = os.path.join(tempfile.gettempdirb(),
-                                      self.PREFIX + name)
+                # Base32 of 14 random bytes gives 23 characters
+                # before any padding.
+                name = base64.b32encode(os.urandom(14))[:name_len].lower()
+            self._addr_family = socket.AF_UNIX
+            self._sock_type = _UNIX_SOCK_TYPE
+            self._addr = self._TEMP_DIR_PREFIX + self.PREFIX + name
             self._needs_unlink = True
-        elif SUPPORTS_ANY_SHARE:
+            return name
+
+    elif SUPPORTS_ANY_SHARE:
+        def _init_addr(self, name, allowed_inet_ports):
             allowed_inet_ports = allowed_inet_ports or DEFAULT_ALLOWED_PORTS
             if name:
-                position = hash(name) % (len(allowed_inet_ports) + 1)
-                port = allowed_inet_ports[position]
+                port = name_to_port_number(name, allowed_inet_ports)
             else:
                 port = name = random.choice(allowed_inet_ports)
             self._addr_family = socket.AF_INET
+            self._sock_type = socket.SOCK_STREAM
             self._addr = ('127.0.0.1', port)
-        else:
+            return name
+
+    else:
+        def _init_addr(self, name, allowed_inet_ports):
             raise NotImplementedError(
                 'Socket handle sharing not implemented on this platform.'
             )
-        self._name = name
-        self._max_waiters = max_waiters
-        self._socket = None
 
     if SUPPORTS_CMSG_SHARE:
-        def _send_listening_fd(self, target_sock: socket.socket):
+        # Constants used on the handoff path are bound as defaults so they're
+        # local lookups rather than module global and attribute lookups.
+        def _send_listening_fd(
+            self,
+            target_sock: socket.socket,
+            _sol_socket=socket.SOL_SOCKET,
+            _scm_rights=socket.SCM_RIGHTS,
+            _pack_fd=_FD_PACK
+        ):
             msgs = (b'a',)
             cmsgs = (
                     (
-                        socket.SOL_SOCKET,
-                        socket.SCM_RIGHTS,
-                        bytes(array.array("i", (self._socket.fileno(),)))
+                        _sol_socket,
+                        _scm_rights,
+                        _pack_fd(self._socket.fileno())
                     ),
             )
+            # The kernel holds a reference to the fd while it's queued, so
+            # we're free to close ours as soon as this returns.
             target_sock.sendmsg(msgs, cmsgs)
 
-        def _recv_listening_sock(self, source_sock):
-            fds = array.array("i")  # Array of ints
+        def _recv_listening_sock(
+            self,
+            source_sock,
+            _sol_socket=socket.SOL_SOCKET,
+            _scm_rights=socket.SCM_RIGHTS,
+            _fd_size=_FD_STRUCT.size,
+            _unpack_fd_from=_FD_STRUCT.unpack_from
+        ):
             _msg, ancdata, flags, addr = source_sock.recvmsg(
                 1,
-                socket.CMSG_LEN(fds.itemsize)
+                _CMSG_LEN_1_FD,
+                _RECVMSG_FLAGS
             )
+            listening_fd = None
             for cmsg_level, cmsg_type, cmsg_data in ancdata:
-                if (cmsg_level == socket.SOL_SOCKET and
-                        cmsg_type == socket.SCM_RIGHTS):
-                    # Append data, ignoring any truncated integers at the end.
-                    cmsg_end = len(cmsg_data) - (len(cmsg_data) % fds.itemsize)
-                    fds.fromstring(cmsg_data[:cmsg_end])
-            if not _msg:
+                if (cmsg_level == _sol_socket and
+                        cmsg_type == _scm_rights and
+                        len(cmsg_data) >= _fd_size):
+                    listening_fd, = _unpack_fd_from(cmsg_data)
+            if not _msg or listening_fd is None:
                 logger.debug('Probable race condition. Waiting connection for '
                              '%s closed prematurely.', self._name)
                 return False
-            listening_fd = fds[0]
-            self._socket = socket.fromfd(
-                listening_fd,
-                self._addr_family,
-                socket.SOCK_STREAM
-            )
+            if not _RECVMSG_FLAGS:
+                os.set_inheritable(listening_fd, False)
+            # Wrap the received descriptor as-is rather than dup it with
+            # fromfd.
+            self._socket = self._make_socket(fileno=listening_fd)
+            # The fd is already non-blocking, but a default timeout would
+            # give the wrapper its own and make accept() in release() poll.
+            if socket.getdefaulttimeout() is not None:
+                self._socket.setblocking(False)
             return True
 
     elif SUPPORTS_ANY_SHARE:
         def _send_listening_fd(self, target_sock: socket.socket):
-            pid_buffer = bytearray()
-            while len(pid_buffer) < dword.size:
-                recvd = target_sock.recv(dword.size - len(pid_buffer))
-                if not recvd:
-                    return
-                pid_buffer += recvd
+            target_sock.setblocking(True)
+            pid_buffer = _recv_exactly(target_sock, dword.size)
+            if pid_buffer is None:
+                return
             target_pid, = dword.unpack(pid_buffer)
             handle_bytes = self._socket.share(target_pid)
-            target_sock.sendall(bytes(len(handle_bytes),) + handle_bytes)
+            # Shared handles can be longer than 255 bytes, so the length
+            # prefix is a dword rather than a single byte.
+            target_sock.sendall(dword.pack(len(handle_bytes)) + handle_bytes)
+
+            # Unlike SCM_RIGHTS, a shared handle isn't referenced by the
+            # kernel until the other side imports it. A clean disconnect means
+            # that has happened and we can close ours.
+            stuff = target_sock.recv(2)
+            if stuff:
+                logger.debug('Unexpected handoff response instead of FIN for '
+                             '%s: %s', self._name, stuff)
 
         def _recv_listening_sock(self, source_sock):
             # Other end needs our PID to prepare a handle for us
             source_sock.sendall(dword.pack(os.getpid(),))
-            handle_bytes = bytearray(source_sock.recv(8))
-            if handle_bytes:
-                expected_fd_bytes_length = handle_bytes[0] + 1
-                while len(handle_bytes) < expected_fd_bytes_length:
-                    recvd_bytes = source_sock.recv(8)
-                    if not recvd_bytes:
-                        # Socket closed during hand-over
-                        handle_bytes = b''
-                        break
-                    handle_bytes += recvd_bytes
-
-            if handle_bytes:
-                self._socket = socket.fromshare(handle_bytes)
-                return True
-            return False
+            length_buffer = _recv_exactly(source_sock, dword.size)
+            if length_buffer is None:
+                return False
+            handle_length, = dword.unpack(length_buffer)
+            handle_bytes = _recv_exactly(source_sock, handle_length)
+            if handle_bytes is None:
+                # Socket closed during hand-over
+                return False
+            self._socket = socket.fromshare(bytes(handle_bytes))
+            # Don't count on the imported handle sharing the original's
+            # non-blocking mode.
+            self._socket.setblocking(False)
+            return True
 
-    def attempt_listen(self):
-        self._socket = socket.socket(self._addr_family, socket.SOCK_STREAM)
+    def attempt_listen(self, sock: Optional[socket.socket] = None):
+        # If the address is taken, a passed-in sock is left open and unbound
+        # so the caller can connect to the current acquirer with it.
+        if sock is None:
+            sock = self._new_socket()
+            keep_on_failure = False
+        else:
+            keep_on_failure = True
         try:
-            self._socket.bind(self._addr)
-            self._socket.listen(self._max_waiters)
-            return True
-        except socket.error:
+            sock.bind(self._addr)
+        except OSError as error:
             # Someone else probably has the lock.
+            if not keep_on_failure or error.errno != errno.EADDRINUSE:
+                sock.close()
+            return False
+        try:
+            sock.listen(self._max_waiters)
+        except OSError:
+            sock.close()
             return False
+        # release() polls for waiters with accept(). O_NONBLOCK lives on the
+        # shared file description, so this sticks across handoffs and
+        # release() doesn't need to toggle it.
+        sock.setblocking(False)
+        self._socket = sock
+        return True
 
-    def attempt_connect_and_recv(self):
-        # Wait on someone else to give us the lock
-        with socket.socket(self._addr_family, socket.SOCK_STREAM) as wait_sock:
-            wait_sock.setblocking(True)
-            connected = False
-            for backoff in (0.0001, 0.001, 0.01, 0.1):
-                try:
-                    wait_sock.connect(self._addr)
-                except ConnectionRefusedError:
-                    logger.debug('Possible race condition. Connection for %s '
-                                 'refused, possibly before listener could '
-                                 'enter listen mode.', self._name)
-                    time.sleep(backoff)
-                except FileNotFoundError:
-                    logger.debug('Possible race condition. Listener for %s '
-                                 'closed and deleted file before we could '
-                                 'connect.', self._name)
-                    return False
-                else:
-                    connected = True
-                    break
+    def attempt_connect_and_recv(
+        self,
+        wait_sock: Optional[socket.socket] = None
+    ):
+        # Wait on someone else to give us the lock. If the connect attempt
+        # fails, wait_sock is left unconnected so the caller can retry with
+        # it. Once connected, it's used up and closed here.
+        if wait_sock is None:
+            with self._new_socket() as wait_sock:
+                return self.attempt_connect_and_recv(wait_sock)
 
-            if not connected:
-                raise RuntimeError('Could not connect to current acquierer.')
+        try:
+            wait_sock.connect(self._addr)
+        except ConnectionRefusedError:
+            # The acquirer is between bind() and listen() or is tearing
+            # its listener down. Either way, acquire() retries right away
+            # instead of sleeping through the window.
+            logger.debug('Possible race condition. Connection for %s '
+                         'refused, possibly before listener could '
+                         'enter listen mode.', self._name)
+            return False
+        except FileNotFoundError:
+            logger.debug('Possible race condition. Listener for %s '
+                         'closed and deleted file before we could '
+                         'connect.', self._name)
+            return False
 
+        with wait_sock:
             # Block until we receive the listening socket's handle or
             # are disconnected:
-            acquired = self._recv_listening_sock(wait_sock)
-        return acquired
+            try:
+                return self._recv_listening_sock(wait_sock)
+            except ConnectionResetError:
+                logger.debug('Probable race condition. Listener for %s '
+                             'closed with our connection still queued.',
+                             self._name)
+                return False
+
+    def _new_socket(self):
+        sock = self._make_socket()
+        # New sockets only start out non-blocking if a default timeout was
+        # set, so skip the extra syscall otherwise.
+        if socket.getdefaulttimeout() is not None:
+            sock.setblocking(True)
+        return sock
 
     def acquire(self):
-        while True:
-            if self.attempt_listen():
-                break
-            if self.attempt_connect_and_recv():
-                break
+        # One socket serves each round: if bind fails it's used to connect
+        # to the current acquirer instead. On Unix domain sockets, a refused
+        # connect leaves it unbound for the next round, so under contention
+        # we only pay for a new one after a real connection.
+        sock = None
+        addr_watch = None
+        refused_since = None
+        try:
+            while True:
+                if sock is None or sock.fileno() == -1:
+                    sock = self._new_socket()
+                    sock_is_fresh = True
+                if self.attempt_listen(sock):
+                    sock = None
+                    break
+                if sock.fileno() == -1:
+                    # bind failed for a reason other than the address being
+                    # taken. If that might be down to reusing the socket,
+                    # try binding a fresh one before falling back to connect.
+                    if not sock_is_fresh:
+                        continue
+                    sock = self._new_socket()
+                sock_is_fresh = False
+                if self.attempt_connect_and_recv(sock):
+                    break
+                if sock.fileno() == -1:
+                    # We got through to a listener, so the address is live.
+                    refused_since = None
+                else:
+                    # Something that isn't listening can hold the address
+                    # indefinitely, like a socket file left behind by a
+                    # crashed acquirer or an unrelated socket on our port.
+                    now = time.monotonic()
+                    if refused_since is None:
+                        refused_since = now
+                    elif now - refused_since > _REFUSED_CONNECT_TIMEOUT:
+                        raise RuntimeError(
+                            'Could not connect to current acquirer. Address '
+                            '{!r} is taken but not listening.'.format(
+                                self._addr
+                            )
+                        )
+                if self._addr_family != socket.AF_UNIX:
+                    # A refused TCP connect can leave the socket implicitly
+                    # bound to an ephemeral port, which would make our next
+                    # bind fail.
+                    sock.close()
+                if self._needs_unlink and _DirectoryWatch:
+                    # A socket file can outlive its listener for a while.
+                    # Retry once right away, then wait for the directory to
+                    # change instead of spinning on bind and connect.
+                    if addr_watch is None:
+                        addr_watch = _DirectoryWatch(
+                            os.path.dirname(self._addr)
+                        )
+                    else:
+                        addr_watch.wait(_DIRECTORY_WAIT_TIMEOUT)
+        finally:
+            if sock is not None:
+                sock.close()
+            if addr_watch is not None:
+                addr_watch.close()
 
     def release(self):
         # Accept the first connect, it's the next-waiting acquirer we'll pass
         # the unlockededness to.
-        self._socket.setblocking(False)
         try:
             next_acquirer = self._socket.accept()[0]
         except Exception:
@@ -211,13 +421,6 @@ class SocketLock(AbstractContextManager):
         # Pass the listening socket fd to the next acquirer
         self._send_listening_fd(next_acquirer)
 
-        # A clean disconnect means other side has duplicated the fd and we can
-        # close ours.
-        next_acquirer.setblocking(True)
-        stuff = next_acquirer.recv(2)
-        if stuff:
-            logger.debug('Unexpected handoff response instead of FIN for %s: '
-                         '%s', self._name, stuff)
         # Nothing else left to do with our own descriptors, close em
         next_acquirer.close()
         self._socket.close()
@@ -233,13 +436,22 @@ class SocketLockThreadSafe(SocketLock):
     def __init__(self, *args, **kwargs):
         # Order of operations on the sockets is important and multithreaded
         # activity in a lock instance can mess that order up, so we use
-        # a typical thread lock to keep that from happening.
+        # a typical thread lock to keep that from happening. On Linux these
+        # are already futex-backed, so the uncontended path stays in
+        # userspace. A flag flipped with compare-and-swap wouldn't be
+        # enough: a second thread has to block until the holder releases,
+        # and with only one listening socket per instance there's nothing
+        # else for it to block on.
         self._thread_lock = _thread.allocate_lock()
         super().__init__(*args, **kwargs)
 
     def acquire(self):
         self._thread_lock.acquire()
-        super().acquire()
+        try:
+            super().acquire()
+        except BaseException:
+            self._thread_lock.release()
+            raise
 
     def release(self):
         super().release()
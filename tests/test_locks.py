@@ -1,6 +1,12 @@
+import functools
 import multiprocessing
+import os
+import socket
+import threading
 import time
 
+import pytest
+
 import socklocks
 
 
@@ -26,3 +32,212 @@ def test_lock_across_processes():
 
         assert end - start >= 0.5
         assert results == [2, 3, 4, 5, 6]
+
+
+def test_handoff_releases_listener():
+    holder = socklocks.SocketLock('handoff_test')
+    waiter = socklocks.SocketLock('handoff_test')
+    holder.acquire()
+
+    waiter_thread = threading.Thread(target=waiter.acquire)
+    waiter_thread.start()
+    # Give the waiter time to connect to the holder's listener.
+    time.sleep(0.1)
+    holder.release()
+    waiter_thread.join(timeout=5)
+    assert not waiter_thread.is_alive()
+    waiter.release()
+
+    # No process should still be holding onto the handed-off listener.
+    newcomer = socklocks.SocketLock('handoff_test')
+    assert newcomer.attempt_listen()
+    newcomer.release()
+
+
+def test_name_to_port_number():
+    allowed_ports = range(10000, 10003)
+    ports = {
+        socklocks.name_to_port_number(b'lock%d' % i, allowed_ports)
+        for i in range(100)
+    }
+    assert ports == set(allowed_ports)
+    # Independent processes must agree, so the mapping can't depend on
+    # per-process hash salting.
+    assert socklocks.name_to_port_number(b'fancy_lock') == 61324
+
+
+def test_recv_exactly():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sender.sendall(b'ab')
+        sender.sendall(b'cd')
+        assert socklocks._recv_exactly(receiver, 3) == b'abc'
+        sender.close()
+        assert socklocks._recv_exactly(receiver, 2) is None
+
+
+def test_release_after_handoff_with_default_timeout():
+    socket.setdefaulttimeout(3)
+    try:
+        holder = socklocks.SocketLock('default_timeout_test')
+        waiter = socklocks.SocketLock('default_timeout_test')
+        holder.acquire()
+
+        waiter_thread = threading.Thread(target=waiter.acquire)
+        waiter_thread.start()
+        time.sleep(0.1)
+        holder.release()
+        waiter_thread.join(timeout=5)
+        assert not waiter_thread.is_alive()
+
+        # With no one waiting, release shouldn't sit out the timeout.
+        start = time.monotonic()
+        waiter.release()
+        assert time.monotonic() - start < 1
+    finally:
+        socket.setdefaulttimeout(None)
+
+
+@pytest.mark.skipif(not socklocks.SUPPORTS_UNIX_SOCKS,
+                    reason='Socket files need Unix domain sockets.')
+def test_stale_socket_file_raises(tmp_path):
+    lock = socklocks.SocketLock()
+    # Force the socket file address scheme regardless of platform.
+    lock._addr = os.fsencode(tmp_path / 'stale')
+    lock._needs_unlink = True
+
+    # Leave a socket file behind with nothing listening on it, like a
+    # crashed acquirer would.
+    stale = socket.socket(socket.AF_UNIX, lock._sock_type)
+    stale.bind(lock._addr)
+    stale.close()
+
+    with pytest.raises(RuntimeError):
+        lock.acquire()
+
+
+def test_squatted_port_raises():
+    lock = socklocks.SocketLock()
+    # Force the AF_INET address scheme regardless of platform.
+    lock._addr_family = socket.AF_INET
+    lock._make_socket = functools.partial(socket.socket, socket.AF_INET,
+                                          socket.SOCK_STREAM)
+    lock._needs_unlink = False
+
+    # Some unrelated socket is bound to the lock's port but isn't listening.
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as squatter:
+        squatter.bind(('127.0.0.1', 0))
+        lock._addr = squatter.getsockname()
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+
+
+@pytest.mark.parametrize('family, reuses_socket', (
+    (socket.AF_INET, False),
+    pytest.param(socket.AF_UNIX, True, marks=pytest.mark.skipif(
+        not socklocks.SUPPORTS_UNIX_SOCKS,
+        reason='Needs Unix domain sockets.'
+    )),
+))
+def test_socket_reuse_after_refused_connect(family, reuses_socket):
+    lock = socklocks.SocketLock()
+    lock._addr_family = family
+    lock._make_socket = functools.partial(socket.socket, family,
+                                          socket.SOCK_STREAM)
+    bind_socks = []
+
+    def attempt_listen(sock):
+        # Address taken the first time around, free the second.
+        bind_socks.append(sock)
+        return len(bind_socks) > 1
+
+    lock.attempt_listen = attempt_listen
+    lock.attempt_connect_and_recv = lambda sock: False
+    lock.acquire()
+    bind_socks[-1].close()
+
+    assert (bind_socks[0] is bind_socks[1]) == reuses_socket
+
+
+@pytest.mark.skipif(not socklocks.SUPPORTS_UNIX_SOCKS,
+                    reason='Needs Unix domain sockets.')
+def test_failed_bind_on_reused_socket_retries_bind():
+    lock = socklocks.SocketLock()
+    lock._addr_family = socket.AF_UNIX
+    lock._make_socket = functools.partial(socket.socket, socket.AF_UNIX,
+                                          socket.SOCK_STREAM)
+    bind_socks = []
+    connect_socks = []
+
+    def attempt_listen(sock):
+        bind_socks.append(sock)
+        if len(bind_socks) == 2:
+            # Fails for some reason other than the address being taken.
+            sock.close()
+        return len(bind_socks) > 2
+
+    def attempt_connect_and_recv(sock):
+        connect_socks.append(sock)
+        return False
+
+    lock.attempt_listen = attempt_listen
+    lock.attempt_connect_and_recv = attempt_connect_and_recv
+    lock.acquire()
+    bind_socks[-1].close()
+
+    assert len(connect_socks) == 1
+    assert bind_socks[2] is not bind_socks[1]
+
+
+def test_socket_file_retries_wait_on_directory(monkeypatch, tmp_path):
+    watches = []
+
+    class FakeDirectoryWatch:
+        def __init__(self, path):
+            self.path = path
+            self.waits = 0
+            self.closed = False
+            watches.append(self)
+
+        def wait(self, timeout):
+            self.waits += 1
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(socklocks, '_DirectoryWatch', FakeDirectoryWatch)
+    lock = socklocks.SocketLock()
+    lock._addr = os.fsencode(tmp_path / 'lock')
+    lock._needs_unlink = True
+    listen_attempts = []
+
+    def attempt_listen(sock):
+        # Free on the fourth try.
+        listen_attempts.append(sock)
+        return len(listen_attempts) > 3
+
+    lock.attempt_listen = attempt_listen
+    lock.attempt_connect_and_recv = lambda sock: False
+    lock.acquire()
+    listen_attempts[-1].close()
+
+    watch, = watches
+    assert watch.path == os.fsencode(tmp_path)
+    # The first retry is immediate, later ones wait on the directory.
+    assert watch.waits == 2
+    assert watch.closed
+
+
+def test_thread_safe_acquire_failure_releases_thread_lock():
+    lock = socklocks.SocketLockThreadSafe()
+
+    def attempt_listen(sock=None):
+        raise OSError('Simulated failure')
+
+    lock.attempt_listen = attempt_listen
+    with pytest.raises(OSError):
+        lock.acquire()
+
+    # Other threads must still be able to get through the gate.
+    assert lock._thread_lock.acquire(timeout=1)
+    lock._thread_lock.release()